@@ -93,7 +93,7 @@ def prepare_data_generators(samples, labels, batch_size, model_type):
                   for key, sample in samples.items()]
     datagen = image.ImageDataGenerator()
     generator = datagen.flow(
-        x=np.array([image for image, label in image_list]),
+        x=np.array([image for image, label in image_list], dtype=np.float32),
         y=np.array([label for image, label in image_list]),
         batch_size=batch_size,
         shuffle=True,
@@ -4,6 +4,7 @@ from torch import nn
 import torch.optim as optim
 import clip
 import torch
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 from sklearn.metrics import accuracy_score, precision_score, recall_score, roc_auc_score
 from sklearn.metrics import classification_report, confusion_matrix
 import os
@@ -57,13 +58,18 @@ class TrainClipClassifier:
     def convert_models_to_fp32(self, model):
         """
         Converts model parameters and gradients to float32 precision. This is necessary for compatibility with certain optimizers or hardware.
+        The fp16 tensors are cast as two flat buffers instead of one cast per parameter tensor; fp32 parameters are left untouched.
         :params model: The model to convert to float32 precision.
         :return: None. Converts the model parameters and gradients in-place.
         """   
-        for p in model.parameters():
-            if p.grad is not None:
-                p.data = p.data.float()
-                p.grad.data = p.grad.data.float()
+        params = [p for p in model.parameters() if p.grad is not None and p.dtype == torch.float16]
+        if not params:
+            return
+        flat_params = _flatten_dense_tensors([p.data for p in params]).float()
+        flat_grads = _flatten_dense_tensors([p.grad.data for p in params]).float()
+        for p, data, grad in zip(params, _unflatten_dense_tensors(flat_params, params), _unflatten_dense_tensors(flat_grads, params)):
+            p.data = data
+            p.grad.data = grad
 
     def load_clip_model(self):
         """
@@ -214,6 +220,7 @@ class TrainClipClassifier:
         """
         model_save_path = f'results/t_pretrained/{self.medical_type}/clip/best_model.pth'
         os.makedirs(os.path.dirname(model_save_path), exist_ok=True)
+        ground_truth = torch.arange(max(train_loader.batch_size, validation_loader.batch_size), dtype=torch.long, device=self.device)
         for epoch in range(self.epochs):
             self.clip_model.train()
             train_losses = []
@@ -222,10 +229,9 @@ class TrainClipClassifier:
                 inputs = torch.from_numpy(inputs).to(self.device)
                 labels = torch.from_numpy(labels).to(self.device).float().unsqueeze(1)
                 texts = torch.cat([clip.tokenize(f"a photo of {categories[int(label.item())]} lungs.") for label in labels]).to(self.device)
-                self.optimizer.zero_grad()
+                self.optimizer.zero_grad(set_to_none=True)
                 logits_per_image, logits_per_text = self.clip_model(inputs, texts)
-                ground_truth = torch.arange(len(inputs),dtype=torch.long,device=self.device)
-                total_loss = (self.loss_img(logits_per_image,ground_truth) + self.loss_txt(logits_per_text,ground_truth))/2
+                total_loss = (self.loss_img(logits_per_image,ground_truth[:len(inputs)]) + self.loss_txt(logits_per_text,ground_truth[:len(inputs)]))/2
                 total_loss.backward()
                 if self.device == "cpu":
                     self.optimizer.step()
@@ -243,8 +249,7 @@ class TrainClipClassifier:
                 labels = torch.from_numpy(labels).to(self.device).float().unsqueeze(1)
                 texts = torch.cat([clip.tokenize(f"a photo of {categories[int(label.item())]} lungs.") for label in labels]).to(self.device)
                 logits_per_image, logits_per_text = self.clip_model(inputs, texts)
-                ground_truth = torch.arange(len(inputs),dtype=torch.long,device=self.device)
-                total_loss = (self.loss_img(logits_per_image,ground_truth) + self.loss_txt(logits_per_text,ground_truth))/2
+                total_loss = (self.loss_img(logits_per_image,ground_truth[:len(inputs)]) + self.loss_txt(logits_per_text,ground_truth[:len(inputs)]))/2
                 validation_losses.append(total_loss.item())
             avg_validation_loss = np.mean(validation_losses)
             train_acc, train_prec, train_rec, train_auc, _, _ = self.evaluate([train_loader], {"Train":steps["Train"]}, categories)
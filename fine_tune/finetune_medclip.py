@@ -3,27 +3,78 @@ from tqdm import tqdm
 from torch import nn
 import torch.optim as optim
 import torch
-from medclip import MedCLIPModel, MedCLIPVisionModelViT, MedCLIPVisionModel, PromptClassifier
+from medclip import MedCLIPModel, MedCLIPVisionModelViT, MedCLIPVisionModel
 from medclip.prompts import generate_covid_class_prompts, process_class_prompts, generate_rsna_class_prompts
 import clip
 from sklearn.metrics import accuracy_score, precision_score, recall_score, roc_auc_score
 from sklearn.metrics import classification_report, confusion_matrix
 import os
-from torch.cuda.amp import GradScaler, autocast
+import csv
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 
+class CudaPrefetcher:
+    """
+    A class that wraps a batch generator and copies the next batch to the GPU
+    on a side CUDA stream while the current batch is being processed.
+    On CPU it simply converts the batches to tensors.
+    """
+    def __init__(self, generator, device):
+        self.generator = generator
+        self.device = device
+        self.stream = torch.cuda.Stream() if device == "cuda" else None
+        self._preload()
+
+    def _preload(self):
+        """
+        Fetches the next batch from the generator and starts its asynchronous copy to the device.
+        :return: None. The batch is kept until the next call to __next__.
+        """
+        inputs, labels = next(self.generator)
+        inputs, labels = torch.as_tensor(np.ascontiguousarray(inputs, dtype=np.float32)), torch.as_tensor(labels)
+        if self.stream is None:
+            self.batch = inputs, labels
+            return
+        inputs, labels = inputs.pin_memory(), labels.pin_memory()
+        with torch.cuda.stream(self.stream):
+            inputs = inputs.to(self.device, non_blocking=True).contiguous(memory_format=torch.channels_last)
+            self.batch = inputs, labels.to(self.device, non_blocking=True)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        Returns the prefetched batch once its copy is complete and starts prefetching the following one.
+        :return: The inputs and labels of the batch as tensors on the device.
+        """
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            for tensor in self.batch:
+                tensor.record_stream(torch.cuda.current_stream())
+        batch = self.batch
+        self._preload()
+        return batch
+
 class TrainMedClipClassifier:
-    def __init__(self, medical_type, epochs=50):
+    def __init__(self, medical_type, epochs=50, accum_steps=1):
         """
         Initializes the TrainMedClipClassifier with a specific medical type and computational device.
+        :param accum_steps: The number of micro-batches whose gradients are accumulated before each optimizer step.
         """
         self.medical_type = medical_type
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.configure()
-        self.medclip_model, self.clf = self.load_medclip_model(MedCLIPVisionModelViT)
+        self.use_amp = self.device == "cuda"
+        self.amp_dtype = torch.bfloat16 if self.use_amp and torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+        self.scaler = torch.amp.GradScaler("cuda", enabled=self.use_amp and self.amp_dtype == torch.float16)
+        self.medclip_model, self.compiled_model = self.load_medclip_model(MedCLIPVisionModelViT)
+        self._prompt_cache = {}
+        self._cls_prompts = {"COVID": self.tokenize_prompts(["a photo of covid lungs."])}
         self.wd = 1e-2 if self.medical_type == "ucsd" else 1e-4
         self.optimizer = optim.Adam(self.medclip_model.parameters(), lr=1e-5,weight_decay =self.wd)
         self.epochs = epochs
+        self.accum_steps = accum_steps
         self.loss_img = nn.CrossEntropyLoss()
         self.loss_txt = nn.CrossEntropyLoss()
         self.metric_history  = {
@@ -41,6 +92,7 @@ class TrainMedClipClassifier:
         self.early_stopping_patience = 5
         self.early_stopping_counter = 0
         self.best_val_loss = float('inf')
+        self.best_state = None
         self.early_stop = False
         self.max_grad_norm =1
 
@@ -55,30 +107,122 @@ class TrainMedClipClassifier:
         else:
             print("Error configuring NVIDIA library.")
         torch._dynamo.config.suppress_errors = True
+        torch.backends.cudnn.benchmark = True
   
-    def convert_models_to_fp32(self, model):
-        """
-        Converts model parameters and gradients to float32 precision. This is necessary for compatibility with certain optimizers or hardware.
-        :params model: The model to convert to float32 precision.
-        :return: None. Converts the model parameters and gradients in-place.
-        """   
-        for p in model.parameters():
-            if p.grad is not None:
-                p.data = p.data.float()
-                p.grad.data = p.grad.data.float()
-
     def load_medclip_model(self, vision_model_cls):
         """
         Loads the MedCLIP model based on the specified vision model class.
+        The forward pass is compiled once; the eager model is kept so saved state dicts have no compile prefix.
         :param vision_model_cls: The class of the vision model to load.
-        :return: The PromptClassifier instance encapsulating the MedCLIP model.
+        :return: The eager MedCLIP model and its compiled counterpart.
         """
         model = MedCLIPModel(vision_cls=vision_model_cls)
         model.from_pretrained()
-        model.to(self.device)
-        clf = PromptClassifier(model)
-        clf.to(self.device)
-        return model, clf
+        model.to(self.device, memory_format=torch.channels_last)
+        compiled_model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
+        return model, compiled_model
+
+    def preload_to_device(self, generator, n_steps):
+        """
+        Loads a whole dataset onto the computational device once, so no host-to-device copy is needed per step.
+        Images are stored in the autocast dtype; if they would take more than half of the free GPU memory,
+        the dataset is streamed through a CudaPrefetcher instead.
+        :param generator: The data loader of the dataset.
+        :param n_steps: The number of batches in one pass over the dataset.
+        :return: A generator of shuffled device batches (see device_batches), or a CudaPrefetcher.
+        """
+        generator.reset()
+        batches = [next(generator) for _ in range(n_steps)]
+        generator.reset()
+        batch_size = len(batches[0][0])
+        n_samples = sum(len(batch_labels) for _, batch_labels in batches)
+        dtype = self.amp_dtype if self.use_amp else torch.float32
+        n_bytes = n_samples * batches[0][0][0].size * torch.finfo(dtype).bits // 8
+        if self.device == "cuda" and n_bytes > torch.cuda.mem_get_info()[0] // 2:
+            print(f"Dataset needs {n_bytes / 2**30:.2f} GiB on the GPU, streaming it with a prefetcher instead.")
+            return CudaPrefetcher(generator, self.device)
+        inputs = torch.empty((n_samples, *batches[0][0].shape[1:]), dtype=dtype, device=self.device, memory_format=torch.channels_last)
+        start = 0
+        for batch_inputs, _ in batches:
+            inputs[start:start + len(batch_inputs)] = torch.as_tensor(np.ascontiguousarray(batch_inputs, dtype=np.float32)).to(self.device)
+            start += len(batch_inputs)
+        labels = torch.as_tensor(np.concatenate([batch_labels for _, batch_labels in batches])).to(self.device)
+        return self.device_batches(inputs, labels, batch_size)
+
+    def device_batches(self, inputs, labels, batch_size):
+        """
+        Yields batches from device-resident tensors indefinitely, reshuffling the samples on every pass.
+        :param inputs: A tensor with all images of the dataset.
+        :param labels: A tensor with all labels of the dataset.
+        :param batch_size: The number of samples per batch.
+        :return: A generator yielding the inputs and labels of a batch.
+        """
+        while True:
+            order = torch.randperm(len(inputs), device=self.device)
+            for start in range(0, len(inputs), batch_size):
+                index = order[start:start + batch_size]
+                yield inputs[index].contiguous(memory_format=torch.channels_last), labels[index]
+
+    def tokenize_prompts(self, captions):
+        """
+        Tokenizes a list of captions and moves the resulting tensors to the computational device.
+        Results are cached per caption list, so each set of captions is only tokenized once.
+        :param captions: A list of captions to tokenize together.
+        :return: A dictionary with the token tensors (input ids, attention mask) of the captions.
+        """
+        key = tuple(captions)
+        if key not in self._prompt_cache:
+            prompt_inputs = process_class_prompts({"COVID": list(captions)})["COVID"]
+            self._prompt_cache[key] = {name: value.to(self.device) for name, value in prompt_inputs.items()}
+        return self._prompt_cache[key]
+
+    def prompt_embeddings(self):
+        """
+        Encodes the cached COVID prompt with the text encoder in eval mode, so dropout does not perturb the scores.
+        :return: The text embeddings of the COVID prompt.
+        """
+        text_model = self.medclip_model.text_model
+        was_training = text_model.training
+        text_model.eval()
+        with torch.no_grad():
+            prompt_inputs = self._cls_prompts["COVID"]
+            text_embeds = self.medclip_model.encode_text(prompt_inputs["input_ids"], prompt_inputs["attention_mask"])
+        text_model.train(was_training)
+        return text_embeds
+
+    def prompt_scores(self, img_embeds, text_embeds):
+        """
+        Scores image embeddings from a forward pass against the COVID prompt embeddings, as zero_shot_classification does.
+        :param img_embeds: The image embeddings returned by the MedCLIP model.
+        :param text_embeds: The COVID prompt embeddings returned by prompt_embeddings.
+        :return: The prediction scores and labels for the images.
+        """
+        with torch.no_grad():
+            logits = self.medclip_model.compute_logits(img_embeds.detach().float(), text_embeds.float())
+            pred_score = logits.view(-1).sigmoid()
+            pred_label = (pred_score >= 0.6).float()
+        return pred_score, pred_label
+
+    def compute_metrics(self, y_true, y_pred, y_score):
+        """
+        Computes the classification metrics from the collected labels, predictions and scores.
+        :param y_true: The ground truth labels.
+        :param y_pred: The predicted labels.
+        :param y_score: The prediction scores.
+        :return: Accuracy, precision, recall and AUC.
+        """
+        return accuracy_score(y_true, y_pred), precision_score(y_true, y_pred), recall_score(y_true, y_pred), roc_auc_score(y_true, y_score)
+
+    def forward_with_prompts(self, image_batch):
+        """
+        Runs the compiled MedCLIP model on a batch of images against the cached COVID prompt.
+        :param image_batch: A tensor representing a batch of images.
+        :return: The logits of every image for the COVID prompt.
+        """
+        prompt_inputs = self._cls_prompts["COVID"]
+        return self.compiled_model(input_ids=prompt_inputs["input_ids"],
+                                   pixel_values=image_batch,
+                                   attention_mask=prompt_inputs["attention_mask"])['logits']
 
     def zero_shot_classification(self, image_batch):
         """
@@ -88,14 +232,8 @@ class TrainMedClipClassifier:
         :return: The top probabilities and labels for the classification predictions.
         """
         with torch.no_grad():
-            texts = {"COVID": [f"a photo of covid lungs."]}
-            input_dictionary = {'pixel_values': image_batch}
-            cls_prompts = process_class_prompts(texts)
-            input_dictionary['prompt_inputs'] = cls_prompts
-            output = self.clf(**input_dictionary)['logits'].cpu().numpy()
-            pred_score = torch.tensor(output.reshape(1, -1)[0]).sigmoid().numpy().flatten()
-            pred_label = np.ones(len(pred_score))
-            pred_label[pred_score<0.6] = 0
+            pred_score = self.forward_with_prompts(image_batch).float().view(-1).sigmoid()
+            pred_label = (pred_score >= 0.6).float()
         return pred_score, pred_label
 
     def evaluate(self, generators, steps, visualize = False ):
@@ -108,19 +246,23 @@ class TrainMedClipClassifier:
         :return: Accuracy, precision, recall, AUC, classification report, and confusion matrix of the evaluation.
         """
         y_true, y_pred, y_score, y_input = [], [], [], []
-        with torch.no_grad() and autocast():
+        with torch.no_grad(), torch.autocast(device_type=self.device, dtype=self.amp_dtype, enabled=self.use_amp):
             for idx,(data_type, step) in enumerate(steps.items()):
+                batches = CudaPrefetcher(generators[idx], self.device)
                 for _ in tqdm(range(step), desc=f'Evaluate {data_type}'):
-                    inputs, labels = next(generators[idx])
-                    inputs = torch.from_numpy(inputs).to(self.device)
-                    labels = torch.from_numpy(labels).to(self.device).float().unsqueeze(1)
+                    inputs, labels = next(batches)
+                    labels = labels.float().unsqueeze(1)
                     top_probs, top_labels = self.zero_shot_classification(inputs)
-                    y_true.extend(labels.cpu().numpy())
-                    y_pred.extend(top_labels)
-                    y_score.extend(top_probs)
-                    y_input.extend(inputs.cpu().numpy())
+                    y_true.append(labels)
+                    y_pred.append(top_labels)
+                    y_score.append(top_probs)
+                    if visualize:
+                        y_input.append(inputs.cpu())
                 generators[idx].reset()
+        y_true = torch.cat(y_true).cpu().numpy()
+        y_pred, y_score = torch.cat(y_pred).cpu().numpy(), torch.cat(y_score).cpu().numpy()
         if visualize:
+            y_input = torch.cat(y_input).numpy()
             directory = os.path.join("results","visualization", "t_pretrained", self.medical_type, "medclip", "images")
             filename = "prediction_images.pdf"
             filepath = os.path.join(directory, filename)
@@ -184,7 +326,7 @@ class TrainMedClipClassifier:
             plt.savefig(filepath)
             print(f"Results saved to {filepath}")
             plt.close()
-        acc, prec, rec, auc = accuracy_score(y_true, y_pred), precision_score(y_true, y_pred), recall_score(y_true, y_pred), roc_auc_score(y_true, y_score)
+        acc, prec, rec, auc = self.compute_metrics(y_true, y_pred, y_score)
         cr, cm = classification_report(y_true, y_pred), confusion_matrix(y_true, y_pred)
         return acc, prec, rec, auc, cr, cm
 
@@ -218,93 +360,113 @@ class TrainMedClipClassifier:
         """
         model_save_path = f'results/t_pretrained/{self.medical_type}/medclip/best_model.pth'
         os.makedirs(os.path.dirname(model_save_path), exist_ok=True)
-        scaler = torch.cuda.amp.GradScaler()
-        for epoch in range(self.epochs):
-            self.medclip_model.train()
-            train_losses = []
-            for step in tqdm(range(steps["Train"]), desc=f'Epoch {epoch+1}/{self.epochs}, Train'):
-                inputs, labels = next(train_loader)
-                inputs = torch.from_numpy(inputs).to(self.device)
-                labels = torch.from_numpy(labels).to(self.device).float().unsqueeze(1)
-                
-                texts = {"COVID": [f"a photo of {categories[int(labels[i].item())]} lungs." for i in range(len(labels))]}
-               
-                cls_prompts = process_class_prompts(texts)
-                self.optimizer.zero_grad()
-                input_dictionary = {'pixel_values': inputs}
-                input_dictionary['prompt_inputs'] = cls_prompts
-                with autocast():
-                  loss_value = self.medclip_model(input_ids=input_dictionary["prompt_inputs"]["COVID"]["input_ids"],
-                                              pixel_values=input_dictionary["pixel_values"],
-                                              attention_mask=input_dictionary["prompt_inputs"]["COVID"]["attention_mask"],
-                                              return_loss = True)['loss_value']
-                  scaler.scale(loss_value).backward()
-                  scaler.unscale_(self.optimizer)
-                  torch.nn.utils.clip_grad_norm_(self.medclip_model.parameters(), self.max_grad_norm)
-                  scaler.step(self.optimizer)
-                  scaler.update()
-                  
-                train_losses.append(loss_value.item())
-            avg_train_loss = np.mean(train_losses)
-            self.medclip_model.eval()
-            validation_losses = []
-            for step in tqdm(range(steps["Validation"]), desc=f'Epoch {epoch+1}/{self.epochs}, Validation'):
-                inputs, labels = next(validation_loader)
-                inputs = torch.from_numpy(inputs).to(self.device)
-                labels = torch.from_numpy(labels).to(self.device).float().unsqueeze(1)
-                
-                texts = {"COVID": [f"a photo of {categories[int(labels[i].item())]} lungs." for i in range(len(labels))]}
-               
-                cls_prompts = process_class_prompts(texts)
-                self.optimizer.zero_grad()
-                input_dictionary = {'pixel_values': inputs}
-                input_dictionary['prompt_inputs'] = cls_prompts
-                with autocast():
-                  loss_value = self.medclip_model(input_ids=input_dictionary["prompt_inputs"]["COVID"]["input_ids"],
-                                              pixel_values=input_dictionary["pixel_values"],
-                                              attention_mask=input_dictionary["prompt_inputs"]["COVID"]["attention_mask"],
-                                              return_loss = True)['loss_value']
-                                  
-                validation_losses.append(loss_value.item())
-            avg_validation_loss = np.mean(validation_losses)
-            train_acc, train_prec, train_rec, train_auc, _, _ = self.evaluate([train_loader], {"Train":steps["Train"]})
-            val_acc, val_prec, val_rec, val_auc, _, _ = self.evaluate([validation_loader], {"Validation":steps["Validation"]})
-            self.metric_history['train_loss'].append(avg_train_loss)
-            self.metric_history['val_loss'].append(avg_validation_loss)
-            self.metric_history['train_accuracy'].append(train_acc)
-            self.metric_history['val_accuracy'].append(val_acc)
-            self.metric_history['train_precision'].append(train_prec)
-            self.metric_history['val_precision'].append(val_prec)
-            self.metric_history['train_recall'].append(train_rec)
-            self.metric_history['val_recall'].append(val_rec)
-            self.metric_history['train_auc'].append(train_auc)
-            self.metric_history['val_auc'].append(val_auc)
+        metrics_path = f'results/t_pretrained/{self.medical_type}/medclip/metrics.tsv'
+        with open(metrics_path, "w", newline="") as file:
+            csv.writer(file, delimiter="\t").writerow(["epoch"] + list(self.metric_history))
+        category_prompts = self.tokenize_prompts([f"a photo of {category} lungs." for category in categories])
+        train_batches = self.preload_to_device(train_loader, steps["Train"])
+        validation_batches = self.preload_to_device(validation_loader, steps["Validation"])
+        save_future = None
+        with ThreadPoolExecutor(max_workers=1) as save_executor:
+            for epoch in range(self.epochs):
+                self.medclip_model.train()
+                train_losses = torch.empty(steps["Train"], device=self.device)
+                predictions, seen = torch.empty((3, steps["Train"] * train_loader.batch_size), device=self.device), 0
+                self.optimizer.zero_grad(set_to_none=True)
+                for step in tqdm(range(steps["Train"]), desc=f'Epoch {epoch+1}/{self.epochs}, Train'):
+                    inputs, labels = next(train_batches)
+                    labels = labels.long()
+                    with torch.autocast(device_type=self.device, dtype=self.amp_dtype, enabled=self.use_amp):
+                      outputs = self.compiled_model(input_ids=category_prompts["input_ids"][labels],
+                                                  pixel_values=inputs,
+                                                  attention_mask=category_prompts["attention_mask"][labels],
+                                                  return_loss = True)
+                    loss_value = outputs['loss_value']
+                    # The contrastive loss only sees in-batch negatives, so accumulation averages
+                    # gradients over micro-batches rather than reproducing a true large batch.
+                    group_size = min(self.accum_steps, steps["Train"] - step + step % self.accum_steps)
+                    self.scaler.scale(loss_value / group_size).backward()
+                    if (step + 1) % self.accum_steps == 0 or step + 1 == steps["Train"]:
+                        self.scaler.unscale_(self.optimizer)
+                        torch.nn.utils.clip_grad_norm_(self.medclip_model.parameters(), self.max_grad_norm)
+                        self.scaler.step(self.optimizer)
+                        self.scaler.update()
+                        self.optimizer.zero_grad(set_to_none=True)
+                    train_losses[step] = loss_value.detach()
+                    pred_score, pred_label = self.prompt_scores(outputs['img_embeds'], self.prompt_embeddings())
+                    predictions[:, seen:seen + len(labels)] = torch.stack((labels.float(), pred_label, pred_score))
+                    seen += len(labels)
+                avg_train_loss = train_losses.mean().item()
+                train_acc, train_prec, train_rec, train_auc = self.compute_metrics(*predictions[:, :seen].cpu().numpy())
+                self.medclip_model.eval()
+                text_embeds = self.prompt_embeddings()
+                validation_losses = torch.empty(steps["Validation"], device=self.device)
+                predictions, seen = torch.empty((3, steps["Validation"] * validation_loader.batch_size), device=self.device), 0
+                for step in tqdm(range(steps["Validation"]), desc=f'Epoch {epoch+1}/{self.epochs}, Validation'):
+                    inputs, labels = next(validation_batches)
+                    labels = labels.long()
+                    with torch.no_grad(), torch.autocast(device_type=self.device, dtype=self.amp_dtype, enabled=self.use_amp):
+                      outputs = self.compiled_model(input_ids=category_prompts["input_ids"][labels],
+                                                  pixel_values=inputs,
+                                                  attention_mask=category_prompts["attention_mask"][labels],
+                                                  return_loss = True)
+                    validation_losses[step] = outputs['loss_value'].detach()
+                    pred_score, pred_label = self.prompt_scores(outputs['img_embeds'], text_embeds)
+                    predictions[:, seen:seen + len(labels)] = torch.stack((labels.float(), pred_label, pred_score))
+                    seen += len(labels)
+                avg_validation_loss = validation_losses.mean().item()
+                val_acc, val_prec, val_rec, val_auc = self.compute_metrics(*predictions[:, :seen].cpu().numpy())
+                self.metric_history['train_loss'].append(avg_train_loss)
+                self.metric_history['val_loss'].append(avg_validation_loss)
+                self.metric_history['train_accuracy'].append(train_acc)
+                self.metric_history['val_accuracy'].append(val_acc)
+                self.metric_history['train_precision'].append(train_prec)
+                self.metric_history['val_precision'].append(val_prec)
+                self.metric_history['train_recall'].append(train_rec)
+                self.metric_history['val_recall'].append(val_rec)
+                self.metric_history['train_auc'].append(train_auc)
+                self.metric_history['val_auc'].append(val_auc)
 
-            epochs_range = range(1, epoch + 2)
-            for i, (metric_name) in enumerate(['loss', 'accuracy', 'precision', 'recall', 'auc'], 1):
-                plt.figure(figsize=(10, 6))
-                plt.plot(epochs_range, self.metric_history[f'train_{metric_name}'], label=f'Train {metric_name.capitalize()}')
-                plt.plot(epochs_range, self.metric_history[f'val_{metric_name}'], label=f'Validation {metric_name.capitalize()}', linestyle='--')
-                plt.legend(loc='best')
-                plt.title(metric_name.capitalize())
-                plt.tight_layout()
-                plt.savefig(f'results/t_pretrained/{self.medical_type}/medclip/metrics_{metric_name}_epoch.png')
-                plt.close()
+                with open(metrics_path, "a", newline="") as file:
+                    csv.writer(file, delimiter="\t").writerow([epoch + 1] + [self.metric_history[name][-1] for name in self.metric_history])
+
+                print(f"Epoch {epoch+1}/{self.epochs}")
+                print(f"Train - Loss: {avg_train_loss:.4f}, Accuracy: {train_acc:.4f}, Precision: {train_prec:.4f}, Recall: {train_rec:.4f}, AUC: {train_auc:.4f}")
+                print(f"Val - Loss: {avg_validation_loss:.4f}, Accuracy: {val_acc:.4f}, Precision: {val_prec:.4f}, Recall: {val_rec:.4f}, AUC: {val_auc:.4f}")
+                if avg_validation_loss < self.best_val_loss:
+                    self.best_val_loss = avg_validation_loss
+                    self.best_state = {key: value.detach().to("cpu", copy=True) for key, value in self.medclip_model.state_dict().items()}
+                    save_future = save_executor.submit(torch.save, self.best_state, model_save_path)
+                    self.early_stopping_counter = 0
+                else:
+                    self.early_stopping_counter += 1
+                    if self.early_stopping_counter == self.early_stopping_patience:
+                        self.early_stop = True
+                        print("Early stopping triggered.")
+                        break
+        self.plot_history()
+        if save_future is not None:
+            save_future.result()
+        if self.best_state is not None:
+            self.medclip_model.load_state_dict(self.best_state)
+        else:
+            print("Validation loss never improved, keeping the last weights.")
 
-            print(f"Epoch {epoch+1}/{self.epochs}")
-            print(f"Train - Loss: {avg_train_loss:.4f}, Accuracy: {train_acc:.4f}, Precision: {train_prec:.4f}, Recall: {train_rec:.4f}, AUC: {train_auc:.4f}")
-            print(f"Val - Loss: {avg_validation_loss:.4f}, Accuracy: {val_acc:.4f}, Precision: {val_prec:.4f}, Recall: {val_rec:.4f}, AUC: {val_auc:.4f}")
-            if avg_validation_loss < self.best_val_loss:
-                self.best_val_loss = avg_validation_loss
-                torch.save(self.medclip_model.state_dict(), model_save_path)
-                self.early_stopping_counter = 0
-            else:
-                self.early_stopping_counter += 1
-                if self.early_stopping_counter == self.early_stopping_patience:
-                    self.early_stop = True
-                    print("Early stopping triggered.")
-                    break
-        self.medclip_model.load_state_dict(torch.load(model_save_path))
+    def plot_history(self):
+        """
+        Plots the training and validation curves of every tracked metric once training has finished.
+        :return: None. One figure per metric is saved next to the best model.
+        """
+        epochs_range = range(1, len(self.metric_history['train_loss']) + 1)
+        for metric_name in ['loss', 'accuracy', 'precision', 'recall', 'auc']:
+            plt.figure(figsize=(10, 6))
+            plt.plot(epochs_range, self.metric_history[f'train_{metric_name}'], label=f'Train {metric_name.capitalize()}')
+            plt.plot(epochs_range, self.metric_history[f'val_{metric_name}'], label=f'Validation {metric_name.capitalize()}', linestyle='--')
+            plt.legend(loc='best')
+            plt.title(metric_name.capitalize())
+            plt.tight_layout()
+            plt.savefig(f'results/t_pretrained/{self.medical_type}/medclip/metrics_{metric_name}_epoch.png')
+            plt.close()
 
     def run(self, generators, steps, categories = ['normal', 'covid']):
         """